@@ -1,51 +1,55 @@
 
 import os
 import re
+import mmap
+from concurrent.futures import ProcessPoolExecutor
 
 LOG_DIR = "data_logs"
+RATES_RE = re.compile(rb"^# Rates:.*(?:\n|$)", re.M)
+ECG_LINE = b"\n>ecg_raw:"
 
 def fix_file(filepath):
     print(f"Processing {filepath}...")
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        with open(filepath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                content = b""
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    content = mm.read()
     except Exception as e:
         print(f"  Error reading {filepath}: {e}")
         return
     
-    new_lines = []
-    ecg_count = 0
+    # Làm việc trực tiếp trên bytes: tìm các dòng "# Rates:" bằng regex,
+    # đếm số dòng ECG giữa hai dòng Rates liên tiếp bằng bytes.count
+    pieces = []
+    last_end = 0   # Vị trí cuối đoạn đã chép sang pieces
+    prev = 0       # Vị trí ngay sau dòng Rates trước đó (bộ đếm reset tại đây)
     modified = False
     
-    for line in lines:
-        if line.startswith(">ecg_raw:"):
-            ecg_count += 1
-            new_lines.append(line)
-        elif line.startswith("# Rates:"):
-            # Check if ECG is already in there
-            if "ECG=" in line:
-                new_lines.append(line)
-                ecg_count = 0 
-            else:
-                # Insert ECG entry
-                # Current: # Rates: PPG=160Hz, Audio=250Hz
-                # New:     # Rates: ECG=XXXHz, PPG=160Hz, Audio=250Hz
-                parts = line.strip().split("# Rates: ")
-                if len(parts) > 1:
-                    content = parts[1]
-                    new_content = f"ECG={ecg_count}Hz, {content}"
-                    new_lines.append(f"# Rates: {new_content}\n")
-                    modified = True
-                else:
-                    new_lines.append(line)
-                
-                ecg_count = 0 # Reset for next second
-        else:
-            new_lines.append(line)
-            
+    for m in RATES_RE.finditer(content):
+        line = m.group()
+        if b"ECG=" not in line:
+            # Insert ECG entry
+            # Current: # Rates: PPG=160Hz, Audio=250Hz
+            # New:     # Rates: ECG=XXXHz, PPG=160Hz, Audio=250Hz
+            parts = line.strip().split(b"# Rates: ")
+            if len(parts) > 1:
+                # Tính cả ký tự xuống dòng kết thúc dòng Rates trước đó
+                ecg_count = content.count(ECG_LINE, max(prev - 1, 0), m.start())
+                if prev == 0 and content.startswith(ECG_LINE[1:]):
+                    ecg_count += 1
+                pieces.append(content[last_end:m.start()])
+                pieces.append(b"# Rates: ECG=%dHz, %s\n" % (ecg_count, parts[1]))
+                last_end = m.end()
+                modified = True
+        prev = m.end() # Reset for next second
+    
     if modified:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.writelines(new_lines)
+        pieces.append(content[last_end:])
+        with open(filepath, 'wb') as f:
+            f.write(b"".join(pieces))
         print(f"  [FIXED] Updated rates in {filepath}")
     else:
         print(f"  [SKIP] No changes needed for {filepath}")
@@ -55,6 +59,10 @@ if __name__ == "__main__":
         print(f"Directory {LOG_DIR} not found.")
     else:
         print(f"Scanning {LOG_DIR}...")
-        for filename in os.listdir(LOG_DIR):
-            if filename.endswith(".txt") and filename.startswith("serial_log_"):
-                fix_file(os.path.join(LOG_DIR, filename))
+        with os.scandir(LOG_DIR) as it:
+            paths = [e.path for e in it
+                     if e.name.startswith("serial_log_") and e.name.endswith(".txt")
+                     and e.is_file()]
+        # Mỗi file độc lập -> xử lý song song trên nhiều core
+        with ProcessPoolExecutor() as ex:
+            list(ex.map(fix_file, paths))
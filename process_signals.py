@@ -8,24 +8,24 @@ ECG Pipeline:
   2. Nội suy lại các điểm artifact
   3. Notch filter 50Hz (loại nhiễu điện lưới)
   4. Bandpass filter 0.5-40Hz
-  5. Wavelet denoising (tùy chọn)
 
 PPG Pipeline:
   1. Bandpass filter 0.5-5Hz
-  2. Wavelet denoising
+  2. Wavelet denoising (tùy chọn, --wavelet)
 """
 
 import os
-import sys
-import glob
 import re
 import argparse
-import collections
+import functools
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy import signal
-from scipy.ndimage import median_filter
+from scipy.signal import detrend
+from scipy.ndimage import binary_dilation
 
 # Thử import pywt, nếu không có thì bỏ qua wavelet
 try:
@@ -41,66 +41,100 @@ DEFAULT_FS_PPG = 100
 DEFAULT_FS_AUDIO = 1000   
 OUTPUT_DIR = "processed_data"
 WINDOW_SEC = 10.0        
+PLOT_MAX_POINTS = 4000   # Số điểm tối đa cho mỗi đường vẽ (~2x độ rộng ảnh)
+ECG_NOTCH_ENABLED = False  # Bật notch 50Hz trong chuỗi lọc ECG
+ECG_NOTCH_FREQ = 50.0      # Tần số điện lưới (Hz)
+ECG_INTERNAL_FS = 250.0    # ECG được hạ mẫu về ~250Hz trước khi lọc (0 = giữ nguyên fs)
+PARSE_CACHE_VERSION = 2    # Tăng khi đổi cách parse log (_LINE_RE, _CHANNEL_FIELDS, runtime) -> bỏ cache <log>.npz cũ
+
+# Các kênh được xử lý song song -> in qua log() để các dòng không bị xen lẫn
+_print_lock = threading.Lock()
+
+def log(msg):
+    """print an toàn khi gọi từ nhiều thread"""
+    with _print_lock:
+        print(msg)
+
+# Định dạng dòng dữ liệu: >name:value (đầu dòng)
+_LINE_RE = re.compile(rb'^>(\w+):(-?[\d.]+)', re.M)
+_RECORD_DTYPE = [('name', 'S16'), ('value', 'f8')]
+
+# Kênh dữ liệu -> các tên trường trong log (audio có 2 tên)
+_CHANNEL_FIELDS = {
+    'ecg_raw': [b'ecg_raw'],
+    'ppg_ir_raw': [b'ppg_ir_raw'],
+    'ppg_red_raw': [b'ppg_red_raw'],
+    'audio_raw': [b'audio', b'audio_raw'],
+}
+
+# Tên sensor -> các tên trường đánh dấu sensor đó (dùng để gán runtime_sec)
+_SENSOR_FIELDS = {
+    'ecg': [b'ecg_raw'],
+    'ppg': [b'ppg_ir_raw'],
+    'audio': [b'audio', b'audio_raw'],
+}
 
 # ĐỌC FILE LOG
+def read_log_records(filepath):
+    """Parse file log -> (data theo kênh, runtime lớn nhất)"""
+    # Parse toàn bộ file trong một lần quét regex (C-level) thay vì từng dòng
+    with open(filepath, 'rb') as f:
+        records = np.fromregex(f, _LINE_RE, _RECORD_DTYPE)
+    names = records['name']
+    values = records['value']
+    
+    # Dữ liệu ADC (<= 24 bit) biểu diễn chính xác bằng float32
+    data = {key: values[np.isin(names, fields)].astype(np.float32)
+            for key, fields in _CHANNEL_FIELDS.items()}
+    
+    # runtime_sec chỉ được tính khi đã có dòng dữ liệu sensor đứng trước nó
+    sensor_fields = [f for fields in _SENSOR_FIELDS.values() for f in fields]
+    after_sensor = np.logical_or.accumulate(np.isin(names, sensor_fields))
+    runtimes = values[(names == b'runtime_sec') & after_sensor]
+    max_runtime = float(runtimes.max()) if len(runtimes) > 0 else 0
+    
+    return data, max_runtime
+
 def parse_log_file(filepath):
-    """Đọc file log và trích xuất dữ liệu ECG, PPG, Audio"""
-    data = {
-        'ecg_raw': [],
-        'ppg_ir_raw': [],
-        'ppg_red_raw': [],
-        'audio_raw': []
-    }
-    
-    max_runtime = {'ecg': 0, 'ppg': 0, 'audio': 0}
-    current_sensor = None
-    
-    with open(filepath, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            
-            # Parse format: >name:value
-            if line.startswith('>'):
-                match = re.match(r'>(\w+):(-?[\d.]+)', line)
-                if match:
-                    name, value = match.group(1), float(match.group(2))
-                    
-                    if name == 'ecg_raw':
-                        data['ecg_raw'].append(value)
-                        current_sensor = 'ecg'
-                    elif name == 'ppg_ir_raw':
-                        data['ppg_ir_raw'].append(value)
-                        current_sensor = 'ppg'
-                    elif name == 'ppg_red_raw':
-                        data['ppg_red_raw'].append(value)
-                    elif name in ['audio', 'audio_raw']:
-                        data['audio_raw'].append(value)
-                        current_sensor = 'audio'
-                    elif name == 'runtime_sec':
-                        if current_sensor:
-                            max_runtime[current_sensor] = max(max_runtime[current_sensor], value)
-    
-    # Convert to numpy arrays
-    for key in data:
-        data[key] = np.array(data[key])
+    """
+    Đọc file log và trích xuất dữ liệu ECG, PPG, Audio.
+    Kết quả parse được cache cạnh file log (<log>.npz); lần chạy sau
+    đọc lại từ cache nếu file log không thay đổi.
+    """
+    cache_file = filepath + '.npz'
+    cached = None
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(filepath):
+        try:
+            with np.load(cache_file) as npz:
+                if 'version' in npz.files and npz['version'].item() == PARSE_CACHE_VERSION:
+                    cached = ({key: npz[key] for key in _CHANNEL_FIELDS},
+                              npz['max_runtime'].item())
+            if cached is not None:
+                print(f"  [Cache] Loaded parsed data from {cache_file}")
+            else:
+                print(f"  [Cache] Ignoring cache from another parser version: {cache_file}")
+        except Exception as e:
+            print(f"  [Cache] Ignoring unreadable cache: {e}")
+    
+    if cached is not None:
+        data, max_runtime = cached
+    else:
+        data, max_runtime = read_log_records(filepath)
+        try:
+            np.savez(cache_file, version=PARSE_CACHE_VERSION, max_runtime=max_runtime, **data)
+        except OSError as e:
+            print(f"  [Cache] Could not write {cache_file}: {e}")
     
     # Ước tính sample rate thực tế dựa trên runtime cuối cùng
     estimated_fs = {}
     
-    # Lấy runtime lớn nhất (thường là runtime cuối cùng ghi được)
-    max_runtime_val = 0
-    if max_runtime:
-        max_runtime_val = max(max_runtime.values())
-    
-    if max_runtime_val > 0:
+    if max_runtime > 0:
         if len(data['ecg_raw']) > 0:
-            estimated_fs['ecg'] = len(data['ecg_raw']) / max_runtime_val
+            estimated_fs['ecg'] = len(data['ecg_raw']) / max_runtime
         if len(data['ppg_ir_raw']) > 0:
-            estimated_fs['ppg'] = len(data['ppg_ir_raw']) / max_runtime_val
+            estimated_fs['ppg'] = len(data['ppg_ir_raw']) / max_runtime
             
-    print(f"  [Auto-Detect FS] Runtime: {max_runtime_val}s")
+    print(f"  [Auto-Detect FS] Runtime: {max_runtime}s")
     if 'ecg' in estimated_fs:
         print(f"  [Auto-Detect FS] ECG: {estimated_fs['ecg']:.2f} Hz (Samples: {len(data['ecg_raw'])})")
     if 'ppg' in estimated_fs:
@@ -109,6 +143,40 @@ def parse_log_file(filepath):
     return data, estimated_fs
 
 # XỬ LÝ ARTIFACT ECG
+def expand_artifact_mask(artifact_mask, before=5, after=10):
+    """
+    Mở rộng vùng artifact: mỗi điểm artifact kéo theo `before` mẫu trước
+    và `after - 1` mẫu sau nó (giống artifact_mask[idx-before:idx+after] = True),
+    thực hiện bằng một phép dilation thay vì vòng lặp Python.
+    """
+    size = before + after
+    return binary_dilation(artifact_mask, structure=np.ones(size, dtype=bool),
+                           origin=before - size // 2)
+
+def fill_gaps_linear(data, artifact_mask):
+    """
+    Nội suy tuyến tính tại chỗ các đoạn artifact từ hai mẫu tốt kề hai đầu
+    mỗi đoạn (không cần tìm kiếm nhị phân như np.interp). Đoạn chạm biên
+    lấy giá trị mẫu tốt gần nhất - giống np.interp.
+    """
+    n = len(data)
+    edges = np.flatnonzero(np.diff(artifact_mask.view(np.int8), prepend=0, append=0))
+    starts, ends = edges[::2], edges[1::2]   # mỗi đoạn artifact: [start, end)
+    lengths = ends - starts
+    
+    bad_idx = np.flatnonzero(artifact_mask)
+    left = np.repeat(starts - 1, lengths)    # mẫu tốt ngay trước đoạn
+    right = np.repeat(ends, lengths)         # mẫu tốt ngay sau đoạn
+    
+    fp_left = data[np.maximum(left, 0)].astype(np.float64)
+    fp_right = data[np.minimum(right, n - 1)].astype(np.float64)
+    fp_left[left < 0] = fp_right[left < 0]
+    fp_right[right >= n] = fp_left[right >= n]
+    
+    slope = (fp_right - fp_left) / (right - left)
+    data[bad_idx] = slope * (bad_idx - left) + fp_left
+    return data
+
 def remove_ecg_artifacts(data, threshold=500):
     """
     Loại bỏ artifact (tín hiệu tụt về 0).
@@ -120,36 +188,62 @@ def remove_ecg_artifacts(data, threshold=500):
     if len(data) < 10:
         return data
     
-    data = np.array(data, dtype=float)
+    raw = data
+    data = np.asarray(data, dtype=np.float32)
     
     # Tìm các điểm artifact (< threshold)
     artifact_mask = data < threshold
+    if not artifact_mask.any():
+        return data
     
     # Mở rộng vùng artifact (trước 5, sau 10 mẫu)
-    indices = np.where(artifact_mask)[0]
-    for idx in indices:
-        start = max(0, idx - 5)
-        end = min(len(data), idx + 10)
-        artifact_mask[start:end] = True
+    artifact_mask = expand_artifact_mask(artifact_mask, before=5, after=10)
     
     artifact_count = np.sum(artifact_mask)
     if artifact_count > 0:
         pct = artifact_count / len(data) * 100
-        print(f"  [Artifact] Detected {artifact_count} samples ({pct:.1f}%) below {threshold} ADC")
+        log(f"  [Artifact] Detected {artifact_count} samples ({pct:.1f}%) below {threshold} ADC")
     
     # Nội suy các điểm artifact
     if 0 < artifact_count < len(data) * 0.3:
-        good_idx = np.where(~artifact_mask)[0]
-        bad_idx = np.where(artifact_mask)[0]
-        
-        if len(good_idx) > 10:
-            clean = data.copy()
-            clean[bad_idx] = np.interp(bad_idx, good_idx, data[good_idx])
-            return clean
+        if len(data) - artifact_count > 10:
+            # Chỉ sao chép khi thực sự sửa dữ liệu (không ghi đè mảng gốc)
+            if data is raw:
+                data = data.copy()
+            fill_gaps_linear(data, artifact_mask)
     
     return data
 
 # CÁC BỘ LỌC (FILTERS)
+def _float_dtype(data):
+    """float32 giữ nguyên float32, còn lại tính bằng float64"""
+    return np.float32 if np.asarray(data).dtype == np.float32 else np.float64
+
+# Hệ số bộ lọc chỉ phụ thuộc tần số chuẩn hóa (theo Nyquist) -> thiết kế một lần,
+# dùng lại cho mọi kênh. Làm tròn 4 chữ số có nghĩa để các fs ước tính gần nhau
+# (vd 99.98Hz / 100.01Hz) dùng chung một bộ hệ số.
+def _normalized(freq, fs):
+    return float(f"{freq / (0.5 * fs):.4g}")
+
+@functools.lru_cache(maxsize=64)
+def _butter_sos(order, low, high):
+    """Butterworth bandpass dạng SOS (ổn định số hơn b, a)"""
+    return signal.butter(order, [low, high], btype='band', output='sos')
+
+@functools.lru_cache(maxsize=64)
+def _notch_sos(w0, q):
+    """Notch filter dạng SOS"""
+    b, a = signal.iirnotch(w0, q)
+    return signal.tf2sos(b, a)
+
+def _design_bandpass(order, lowcut, highcut, fs):
+    """Thiết kế Butterworth bandpass dạng SOS (đã cache)"""
+    return _butter_sos(order, _normalized(lowcut, fs), _normalized(highcut, fs))
+
+def _design_notch(freq, q, fs):
+    """Thiết kế notch filter dạng SOS (đã cache)"""
+    return _notch_sos(_normalized(freq, fs), q)
+
 def butter_bandpass(data, lowcut, highcut, fs, order=4):
     """Butterworth Bandpass Filter"""
     if len(data) == 0:
@@ -163,14 +257,11 @@ def butter_bandpass(data, lowcut, highcut, fs, order=4):
     if lowcut >= highcut:
         return data
     
-    low = lowcut / nyq
-    high = highcut / nyq
-    
     try:
-        b, a = signal.butter(order, [low, high], btype='band')
-        return signal.filtfilt(b, a, data)
+        sos = _design_bandpass(order, lowcut, highcut, fs)
+        return signal.sosfiltfilt(sos.astype(_float_dtype(data), copy=False), data)
     except Exception as e:
-        print(f"  [Filter Error] Bandpass: {e}")
+        log(f"  [Filter Error] Bandpass: {e}")
         return data
 
 def notch_filter(data, freq, q, fs):
@@ -183,65 +274,162 @@ def notch_filter(data, freq, q, fs):
         return data
     
     try:
-        b, a = signal.iirnotch(freq / nyq, q)
-        return signal.filtfilt(b, a, data)
+        sos = _design_notch(freq, q, fs)
+        return signal.sosfiltfilt(sos.astype(_float_dtype(data), copy=False), data)
     except Exception as e:
-        print(f"  [Filter Error] Notch: {e}")
+        log(f"  [Filter Error] Notch: {e}")
         return data
 
+@functools.lru_cache(maxsize=8)
+def _design_ecg_cascade(fs, notch):
+    """
+    Notch (tùy chọn) + Bandpass 0.5-40Hz order 2 ghép thành một chuỗi SOS,
+    để ECG chỉ cần một lần sosfiltfilt. Trả về None nếu fs quá thấp.
+    """
+    nyq = 0.5 * fs
+    highcut = min(40.0, nyq * 0.95)
+    if 0.5 >= highcut:
+        return None
+    
+    sections = []
+    if notch and ECG_NOTCH_FREQ < nyq:
+        sections.append(_design_notch(ECG_NOTCH_FREQ, 30.0, fs))
+    sections.append(_design_bandpass(2, 0.5, highcut, fs))
+    return np.vstack(sections)
+
+def ecg_decimation_factor(fs):
+    """
+    Hệ số hạ mẫu ECG: 1000Hz -> 4, 500Hz -> 2, <= 300Hz -> 1 (không hạ).
+    Làm tròn thay vì cắt: fs ước lượng từ log dao động quanh giá trị danh định.
+
+    >>> [ecg_decimation_factor(fs) for fs in (998, 1000, 1002, 500, 300)]
+    [4, 4, 4, 2, 1]
+    """
+    if not ECG_INTERNAL_FS or fs <= 300:
+        return 1
+    return max(1, int(round(fs / ECG_INTERNAL_FS)))
+
+@functools.lru_cache(maxsize=8)
+def _decimation_fir(q):
+    """FIR chống alias cho hạ mẫu q lần (giống scipy.signal.decimate ftype='fir')"""
+    return signal.firwin(20 * q + 1, 1.0 / q, window='hamming')
+
+def decimate(data, q):
+    """Hạ mẫu q lần, zero-phase (polyphase FIR đã cache)"""
+    if q <= 1 or len(data) == 0:
+        return data
+    fir = _decimation_fir(q).astype(_float_dtype(data), copy=False)
+    return signal.resample_poly(data, 1, q, window=fir)
+
+def ecg_filter(data, fs):
+    """Lọc ECG bằng chuỗi SOS của _design_ecg_cascade"""
+    if len(data) == 0:
+        return data
+    
+    try:
+        sos = _design_ecg_cascade(fs, ECG_NOTCH_ENABLED)
+        if sos is None:
+            return data
+        return signal.sosfiltfilt(sos.astype(_float_dtype(data), copy=False), data)
+    except Exception as e:
+        log(f"  [Filter Error] ECG cascade: {e}")
+        return data
+
+def soft_threshold_inplace(x, threshold):
+    """Soft threshold tại chỗ: sign(x) * max(|x| - threshold, 0)"""
+    mag = np.abs(x)
+    np.subtract(mag, threshold, out=mag)
+    np.maximum(mag, 0, out=mag)
+    np.copysign(mag, x, out=x)
+    return x
+
+@functools.lru_cache(maxsize=None)
+def _wavelet(name):
+    """pywt.Wavelet theo tên (tạo một lần, dùng lại)"""
+    return pywt.Wavelet(name)
+
 def wavelet_denoise(data, wavelet='db6', level=4):
-    """Wavelet Denoising (soft thresholding)"""
-    if not HAS_PYWT or len(data) < 100:
+    """
+    Wavelet Denoising (soft thresholding) theo trục cuối.
+    data: 1D hoặc 2D (kênh, N) - mỗi kênh có ngưỡng riêng.
+    """
+    n = np.shape(data)[-1]
+    if not HAS_PYWT or n < 100:
         return data
     
     try:
-        max_level = pywt.dwt_max_level(len(data), pywt.Wavelet(wavelet).dec_len)
+        wavelet = _wavelet(wavelet)
+        max_level = pywt.dwt_max_level(n, wavelet.dec_len)
         level = min(level, max_level)
         if level == 0:
             return data
         
-        coeffs = pywt.wavedec(data, wavelet, level=level)
-        sigma = np.median(np.abs(coeffs[-1])) / 0.6745
-        threshold = sigma * np.sqrt(2 * np.log(len(data)))
+        coeffs = pywt.wavedec(data, wavelet, level=level, axis=-1)
         
-        new_coeffs = [coeffs[0]]
-        for c in coeffs[1:]:
-            new_coeffs.append(pywt.threshold(c, threshold, mode='soft'))
+        # Gộp mọi hệ số vào một mảng liên tục -> threshold tất cả các mức
+        # detail trong một lần gọi thay vì từng mức một
+        sizes = [c.shape[-1] for c in coeffs]
+        arr = np.concatenate(coeffs, axis=-1)
+        # np.median dùng partition (O(N)); cho phép partition luôn trên buffer |d| tạm
+        sigma = np.median(np.abs(coeffs[-1]), axis=-1, keepdims=True,
+                          overwrite_input=True) / 0.6745
+        threshold = sigma * np.sqrt(2 * np.log(n))
         
-        return pywt.waverec(new_coeffs, wavelet)[:len(data)]
+        n_approx = sizes[0]
+        soft_threshold_inplace(arr[..., n_approx:], threshold)
+        new_coeffs = np.split(arr, np.cumsum(sizes)[:-1], axis=-1)
+        
+        return pywt.waverec(new_coeffs, wavelet, axis=-1)[..., :n].astype(_float_dtype(data), copy=False)
     except:
         return data
 
+def median3(data):
+    """
+    Median filter 3 điểm bằng sorting network (min/max, không rẽ nhánh).
+    Hai điểm biên giữ nguyên - giống median_filter(size=3, mode='reflect').
+    """
+    data = np.asarray(data)
+    out = data.copy()
+    if len(data) < 3:
+        return out
+    
+    a, b, c = data[:-2], data[1:-1], data[2:]
+    lo = np.minimum(a, b)
+    hi = np.maximum(a, b)
+    np.minimum(hi, c, out=hi)
+    np.maximum(lo, hi, out=out[1:-1])
+    return out
+
 # PIPELINE XỬ LÝ ECG
 def process_ecg(raw_data, fs):
     """
     ECG Processing Pipeline:
     1. Remove artifacts (values < 500)
     2. Median filter (remove spikes)
-    3. Notch filter 50Hz
-    4. Bandpass 0.5-40Hz
-    5. (Optional) Wavelet denoise
+    3. Decimate về ~ECG_INTERNAL_FS (R-peak chỉ cần dải < 40Hz)
+    4. Notch filter 50Hz (ECG_NOTCH_ENABLED)
+    5. Bandpass 0.5-40Hz
+    
+    Kết quả có tần số fs / ecg_decimation_factor(fs).
     """
     if len(raw_data) == 0:
         return raw_data
     
-    print("  [ECG] Processing...")
+    log("  [ECG] Processing...")
     
     # Step 1: Remove artifacts
     cleaned = remove_ecg_artifacts(raw_data, threshold=500)
     
     # Step 2: Light median filter
-    cleaned = median_filter(cleaned, size=3)
+    cleaned = median3(cleaned)
     
-    # Step 3: Notch filter 50Hz
-   # filtered = notch_filter(cleaned, 50.0, 30.0, fs)
-    filtered = cleaned
-    # Step 4: Bandpass 0.5-40Hz (Reduced order to minimize ringing)
-    filtered = butter_bandpass(filtered, 0.5, 40.0, fs, order=2)
+    # Step 3: Decimate -> các bước sau xử lý ít mẫu hơn (1000Hz -> 250Hz)
+    q = ecg_decimation_factor(fs)
+    cleaned = decimate(cleaned, q)
     
-    # Step 5: Wavelet denoise (optional)
-    #if HAS_PYWT:
-     #   filtered = wavelet_denoise(filtered, 'db6', 4)
+    # Step 4 + 5: Notch 50Hz + Bandpass 0.5-40Hz (Reduced order to minimize ringing)
+    # ghép thành một chuỗi SOS -> chỉ một lần lọc thuận/nghịch trên toàn bộ ECG
+    filtered = ecg_filter(cleaned, fs / q)
     
     return filtered
 
@@ -254,7 +442,8 @@ def remove_ppg_artifacts(data):
     if len(data) < 10:
         return data
     
-    data = np.array(data, dtype=float)
+    raw = data
+    data = np.asarray(data, dtype=np.float32)
     
     # Bỏ 15% đầu (thường có transient lớn khi bắt đầu đo)
     skip_samples = int(len(data) * 0.15)
@@ -264,74 +453,89 @@ def remove_ppg_artifacts(data):
         stable_region = data
     
     # Tính ngưỡng dựa trên phần ổn định
-    q1 = np.percentile(stable_region, 10)
-    q3 = np.percentile(stable_region, 90)
+    q1, q3 = np.percentile(stable_region, [10, 90])
     iqr = q3 - q1
     
     # Ngưỡng chặt hơn
     low_thresh = q1 - 1.5 * iqr
     high_thresh = q3 + 1.5 * iqr
     
-    # Tìm artifact trên toàn bộ dữ liệu
-    artifact_mask = (data < low_thresh) | (data > high_thresh)
+    # Tìm artifact trên toàn bộ dữ liệu: ngoài [low, high] <=> |x - mid| > half.
+    # Ngưỡng ép về dtype của data (float32) để phép so sánh không bị nâng lên float64
+    mid = data.dtype.type(0.5 * (low_thresh + high_thresh))
+    half = data.dtype.type(0.5 * (high_thresh - low_thresh))
+    dev = np.subtract(data, mid)
+    np.abs(dev, out=dev)
+    artifact_mask = dev > half
+    if not artifact_mask.any():
+        return data
     
     # Mở rộng vùng artifact (trước 5, sau 10)
-    indices = np.where(artifact_mask)[0]
-    for idx in indices:
-        start = max(0, idx - 5)
-        end = min(len(data), idx + 10)
-        artifact_mask[start:end] = True
+    artifact_mask = expand_artifact_mask(artifact_mask, before=5, after=10)
     
     artifact_count = np.sum(artifact_mask)
     if artifact_count > 0:
         pct = artifact_count / len(data) * 100
-        print(f"  [PPG Artifact] Removed {artifact_count} samples ({pct:.1f}%)")
+        log(f"  [PPG Artifact] Removed {artifact_count} samples ({pct:.1f}%)")
         
         # Nội suy
-        good_idx = np.where(~artifact_mask)[0]
-        bad_idx = np.where(artifact_mask)[0]
-        if len(good_idx) > 10:
-            clean = data.copy()
-            clean[bad_idx] = np.interp(bad_idx, good_idx, data[good_idx])
-            return clean
+        if len(data) - artifact_count > 10:
+            # Chỉ sao chép khi thực sự sửa dữ liệu (không ghi đè mảng gốc)
+            if data is raw:
+                data = data.copy()
+            fill_gaps_linear(data, artifact_mask)
     
     return data
 
-def process_ppg(raw_data, fs):
+def process_ppg(raw_data, fs, use_wavelet=False):
     """
     PPG Processing Pipeline (Improved):
     1. Remove artifacts (outliers)
     2. Baseline drift removal (detrend)
     3. Bandpass 0.5-8Hz (wider range)
-    4. Wavelet denoise
-    5. Moving average smoothing
+    4. Wavelet denoise (tùy chọn, --wavelet)
+    5. Invert
+    
+    raw_data: 1D, hoặc 2D (kênh, N) để lọc IR + Red trong cùng một lượt.
     """
-    if len(raw_data) == 0:
+    raw_data = np.asarray(raw_data)
+    if raw_data.shape[-1] == 0:
         return raw_data
     
-    print("  [PPG] Processing...")
+    log("  [PPG] Processing...")
     
-    # Step 1: Remove artifacts
-    cleaned = remove_ppg_artifacts(raw_data)
+    # Step 1: Remove artifacts (ngưỡng riêng cho từng kênh)
+    if raw_data.ndim == 1:
+        cleaned = remove_ppg_artifacts(raw_data)
+    else:
+        cleaned = np.stack([remove_ppg_artifacts(ch) for ch in raw_data])
     
     # Step 2: Remove baseline drift
-    from scipy.signal import detrend
-    cleaned = detrend(cleaned)
+    # cleaned là bản sao riêng (trừ khi trả về nguyên input) -> detrend tại chỗ
+    cleaned = detrend(cleaned, axis=-1, overwrite_data=cleaned is not raw_data)
     
     # Step 3: Bandpass 0.5-8Hz (wider for more harmonics)
     filtered = butter_bandpass(cleaned, 0.5, 8.0, fs)
     
-    # Step 4: Wavelet denoise
-    if HAS_PYWT:
+    # Step 4: Wavelet denoise (sau bandpass 0.5-8Hz thường không cần -> mặc định tắt)
+    if use_wavelet and HAS_PYWT:
         filtered = wavelet_denoise(filtered, 'sym8', 4)
     
-    # Step 5: Moving average smoothing
-    from scipy.ndimage import uniform_filter1d
-    smoothed = uniform_filter1d(filtered, size=2)
-    
-    # Step 6: Invert signal (Because Absorption increases -> Reflection decreases)
+    # Step 5: Invert signal (Because Absorption increases -> Reflection decreases)
     # We want peaks to represent pulsation (high blood volume)
-    return -smoothed
+    # filtered là mảng mới do sosfiltfilt/waverec tạo ra -> đảo dấu tại chỗ
+    return np.negative(filtered, out=filtered)
+
+def process_audio(raw_data):
+    """Audio: bỏ DC và chuẩn hóa về [-1, 1]"""
+    if len(raw_data) == 0:
+        return np.array([])
+    cleaned = raw_data.astype(np.float32)  # Bản sao để xử lý tại chỗ
+    cleaned -= cleaned.mean()  # Remove DC
+    audio_max = max(cleaned.max(), -cleaned.min())  # = max|x|, không tạo mảng abs tạm
+    if audio_max > 0:
+        cleaned /= audio_max  # Normalize
+    return cleaned
 
 def calculate_spo2(red_raw, red_clean, ir_raw, ir_clean):
     """
@@ -367,18 +571,18 @@ def detect_r_peaks(ecg, fs):
     if len(ecg) < 100:
         return [], 0
     
-    # Normalize
-    ecg_norm = (ecg - np.min(ecg)) / (np.max(ecg) - np.min(ecg) + 1e-6)
+    # Prominence 0.3 theo biên độ đã chuẩn hóa min-max -> quy ra đơn vị gốc
+    # thay vì tạo mảng chuẩn hóa (find_peaks chỉ xét chênh lệch tương đối)
+    ecg_range = float(np.ptp(ecg)) + 1e-6
     
     # Tìm peaks với distance tối thiểu 0.3s (max 200 bpm)
     min_dist = int(0.3 * fs)
-    peaks, _ = signal.find_peaks(ecg_norm, distance=min_dist, prominence=0.3)
+    peaks, _ = signal.find_peaks(ecg, distance=min_dist, prominence=0.3 * ecg_range)
     
-    # Tính heart rate
+    # Tính heart rate (trung bình các khoảng RR = tổng khoảng / số khoảng, không cần np.diff)
     hr = 0
     if len(peaks) > 1:
-        intervals = np.diff(peaks)
-        avg_interval = np.mean(intervals)
+        avg_interval = (peaks[-1] - peaks[0]) / (len(peaks) - 1)
         hr = 60.0 * fs / avg_interval
     
     return peaks, hr
@@ -391,19 +595,18 @@ def detect_ppg_peaks(ppg, fs):
     if len(ppg) < 100:
         return [], 0
         
-    # Normalize Min-Max
-    ppg_norm = (ppg - np.min(ppg)) / (np.max(ppg) - np.min(ppg) + 1e-6)
+    # Biên độ min-max: prominence tính theo tỉ lệ biên độ, không cần chuẩn hóa
+    ppg_range = float(np.ptp(ppg)) + 1e-6
     
     # Distance lớn hơn (0.4s) để né nhiễu dội
     min_dist = int(0.4 * fs)
     
     # Prominence thấp hơn (0.2) do biên độ PPG biến thiên
-    peaks, _ = signal.find_peaks(ppg_norm, distance=min_dist, prominence=0.2)
+    peaks, _ = signal.find_peaks(ppg, distance=min_dist, prominence=0.2 * ppg_range)
     
     hr = 0
     if len(peaks) > 1:
-        intervals = np.diff(peaks)
-        avg_interval_sec = np.mean(intervals) / fs
+        avg_interval_sec = (peaks[-1] - peaks[0]) / (len(peaks) - 1) / fs
         hr = 60.0 / avg_interval_sec
         
     return peaks, hr
@@ -424,22 +627,79 @@ def find_stable_segment(data, fs, window_sec):
     if end_range - start_range < win_len:
         return 0, min(win_len, N)
     
-    best_start = start_range
-    min_noise = float('inf')
-    
     step = int(0.5 * fs)
-    for i in range(start_range, end_range - win_len, step):
-        seg = data[i:i + win_len]
-        # Đánh giá độ ổn định bằng std của derivative
-        noise = np.std(np.diff(seg))
-        if noise < min_noise:
-            min_noise = noise
-            best_start = i
-    
+    starts = np.arange(start_range, end_range - win_len, step)
+    if len(starts) == 0:
+        return start_range, start_range + win_len
+    
+    # Đánh giá độ ổn định bằng phương sai của derivative (np.diff(data)) trong từng cửa sổ.
+    # Prefix sum của d = np.diff(data) và d^2 (không phải của bản thân tín hiệu)
+    # -> mỗi cửa sổ tính trong O(1)
+    d = np.diff(data)
+    n_diff = win_len - 1
+    s1 = np.concatenate(([0.0], np.cumsum(d)))
+    s2 = np.concatenate(([0.0], np.cumsum(d * d)))
+    mean = (s1[starts + n_diff] - s1[starts]) / n_diff
+    var = (s2[starts + n_diff] - s2[starts]) / n_diff - mean * mean
+    
+    best_start = int(starts[np.argmin(var)])
     return best_start, best_start + win_len
 
 
-def create_plot(data, fs_config, output_file, window_sec=30.0):
+def minmax_decimate(t, y, max_points=PLOT_MAX_POINTS):
+    """
+    Giảm số điểm trước khi vẽ: mỗi bucket chỉ giữ điểm min và max
+    (theo đúng thứ tự thời gian) nên đường bao tín hiệu không đổi.
+    """
+    n = len(y)
+    if n <= max_points:
+        return t, y
+    
+    bucket = -(-n // (max_points // 2))   # làm tròn lên
+    n_full = n // bucket
+    m = n_full * bucket
+    blocks = y[:m].reshape(n_full, bucket)
+    
+    offsets = np.arange(n_full) * bucket
+    pairs = np.stack([blocks.argmin(axis=1), blocks.argmax(axis=1)], axis=1) + offsets[:, None]
+    tail = y[m:]
+    if len(tail) > 0:
+        pairs = np.vstack([pairs, [m + tail.argmin(), m + tail.argmax()]])
+    idx = np.unique(np.concatenate(([0], pairs.ravel(), [n - 1])))
+    return t[idx], y[idx]
+
+
+def clamp_range(start, end, n):
+    """Giới hạn khoảng cắt [start, end) trong mảng dài n (luôn start <= end)"""
+    start = max(0, min(start, n - 1))
+    return start, max(start, min(end, n))
+
+
+def _time_axis(s_idx, n, fs, dtype=np.float32):
+    """
+    Trục thời gian (giây) cho n mẫu bắt đầu từ chỉ số s_idx.
+    Giữ dạng số thực: trục datetime (nhất là có timezone) làm matplotlib vẽ chậm hơn nhiều.
+    """
+    return np.arange(s_idx, s_idx + n, dtype=dtype) / fs
+
+
+def processed_cache_path(log_file, fs_config, use_wavelet=False):
+    """
+    Đường dẫn cache tín hiệu đã lọc, khóa theo file log (mtime + size),
+    sample rate, tùy chọn xử lý và chính file script này (đổi pipeline -> cache mới).
+    """
+    st = os.stat(log_file)
+    key = "_".join(str(v) for v in (
+        os.path.abspath(log_file), st.st_mtime_ns, st.st_size,
+        fs_config.get('ecg'), fs_config.get('ppg'), use_wavelet,
+        os.path.getmtime(os.path.abspath(__file__)),
+    ))
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(OUTPUT_DIR, f".cache_{digest}.npz")
+
+
+def create_plot(data, fs_config, output_file, window_sec=30.0, cache_file=None,
+                use_wavelet=False, dpi=150):
     """Tạo biểu đồ 4 hàng: ECG, PPG Red, PPG IR, Audio"""
     
     ecg = data['ecg_raw']
@@ -450,25 +710,55 @@ def create_plot(data, fs_config, output_file, window_sec=30.0):
     fs_ecg = fs_config.get('ecg', DEFAULT_FS_ECG)
     fs_ppg = fs_config.get('ppg', DEFAULT_FS_PPG)
     fs_audio = fs_config.get('audio', 100)  # Audio logging rate
-    
-    # Xử lý tín hiệu
-    ecg_clean = process_ecg(ecg, fs_ecg) if len(ecg) > 0 else np.array([])
-    ppg_ir_clean = process_ppg(ppg_ir, fs_ppg) if len(ppg_ir) > 0 else np.array([])
-    ppg_red_clean = process_ppg(ppg_red, fs_ppg) if len(ppg_red) > 0 else np.array([])
-    
-    # Simple audio processing: remove DC and normalize
-    audio_clean = np.array([])
-    if len(audio) > 0:
-        audio_clean = audio - np.mean(audio)  # Remove DC
-        audio_max = np.max(np.abs(audio_clean))
-        if audio_max > 0:
-            audio_clean = audio_clean / audio_max  # Normalize
+    fs_ecg_clean = fs_ecg / ecg_decimation_factor(fs_ecg)  # process_ecg hạ mẫu ECG
+    
+    # Xử lý tín hiệu (dùng lại kết quả đã lọc nếu có cache)
+    cached = None
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as npz:
+                cached = (npz['ecg'], npz['ppg_ir'], npz['ppg_red'], npz['audio'])
+            print(f"  [Cache] Loaded processed signals from {cache_file}")
+        except Exception as e:
+            print(f"  [Cache] Ignoring unreadable cache: {e}")
+    
+    if cached is not None:
+        ecg_clean, ppg_ir_clean, ppg_red_clean, audio_clean = cached
+    else:
+        # Các kênh độc lập, phần nặng là code C của scipy/pywt (nhả GIL) -> chạy song song
+        with ThreadPoolExecutor(max_workers=4) as ex:
+            # process_* tự trả về mảng rỗng cho kênh rỗng -> không cần kiểm tra ở đây
+            f_ecg = ex.submit(process_ecg, ecg, fs_ecg)
+            f_audio = ex.submit(process_audio, audio)
+            if len(ppg_ir) > 0 and len(ppg_red) > 0:
+                # IR và Red là từng cặp mẫu của MAX30102, cùng bộ lọc -> xử lý chung
+                # dạng (2, N); bỏ vài mẫu lẻ cuối log không có cặp
+                n_ppg = min(len(ppg_ir), len(ppg_red))
+                f_ppg = ex.submit(process_ppg, np.stack([ppg_ir[:n_ppg], ppg_red[:n_ppg]]),
+                                  fs_ppg, use_wavelet)
+            else:
+                # Chỉ có một kênh PPG (firmware chỉ IR, dòng Red bị fix_logs bỏ...) -> xử lý riêng
+                f_ppg = None
+                f_ir = ex.submit(process_ppg, ppg_ir, fs_ppg, use_wavelet)
+                f_red = ex.submit(process_ppg, ppg_red, fs_ppg, use_wavelet)
+            ecg_clean = f_ecg.result()
+            if f_ppg is not None:
+                ppg_ir_clean, ppg_red_clean = f_ppg.result()
+            else:
+                ppg_ir_clean, ppg_red_clean = f_ir.result(), f_red.result()
+            audio_clean = f_audio.result()
+        if cache_file:
+            try:
+                np.savez(cache_file, ecg=ecg_clean, ppg_ir=ppg_ir_clean, ppg_red=ppg_red_clean,
+                         audio=audio_clean)
+            except OSError as e:
+                print(f"  [Cache] Could not write {cache_file}: {e}")
     
     # Tìm đoạn ổn định nhất cho ECG
     if len(ecg_clean) > 0:
-        s_ecg, e_ecg = find_stable_segment(ecg_clean, fs_ecg, window_sec)
-        t_start = s_ecg / fs_ecg
-        t_end = e_ecg / fs_ecg
+        s_ecg, e_ecg = find_stable_segment(ecg_clean, fs_ecg_clean, window_sec)
+        t_start = s_ecg / fs_ecg_clean
+        t_end = e_ecg / fs_ecg_clean
     else:
         t_start, t_end = 0, window_sec
         s_ecg, e_ecg = 0, 0
@@ -476,123 +766,149 @@ def create_plot(data, fs_config, output_file, window_sec=30.0):
     print(f"  [Best Window] ECG: {t_start:.1f}s - {t_end:.1f}s (best {window_sec}s)")
     
     # Cắt ECG
-    ecg_view = ecg_clean[s_ecg:e_ecg] if len(ecg_clean) > 0 else np.zeros(100)
-    ecg_raw_view = ecg[s_ecg:e_ecg] if len(ecg) > 0 else np.zeros(100)
-    
-    # Cắt PPG
-    s_ppg = int(t_start * fs_ppg)
-    e_ppg = int(t_end * fs_ppg)
+    s_ecg_raw = int(t_start * fs_ecg)
     
-    def safe_slice(arr, start, end):
-        if len(arr) == 0: return np.zeros(100)
-        start = max(0, min(start, len(arr)-1))
-        end = max(start, min(end, len(arr)))
-        return arr[start:end]
-
-    ppg_red_view = safe_slice(ppg_red_clean, s_ppg, e_ppg)
-    ppg_ir_view = safe_slice(ppg_ir_clean, s_ppg, e_ppg)
-    ppg_red_raw_view = safe_slice(ppg_red, s_ppg, e_ppg)
-    ppg_ir_raw_view = safe_slice(ppg_ir, s_ppg, e_ppg)
+    # Cắt PPG: mỗi kênh một khoảng chung cho clean/raw (clean có thể ngắn hơn raw vài mẫu),
+    # kênh rỗng không làm mất kênh còn lại
+    s_red, e_red = clamp_range(int(t_start * fs_ppg), int(t_end * fs_ppg),
+                               min(len(ppg_red_clean), len(ppg_red)))
+    s_ir, e_ir = clamp_range(int(t_start * fs_ppg), int(t_end * fs_ppg),
+                             min(len(ppg_ir_clean), len(ppg_ir)))
     
     # Cắt Audio
-    s_audio = int(t_start * fs_audio)
-    e_audio = int(t_end * fs_audio)
-    audio_view = safe_slice(audio_clean, s_audio, e_audio)
-    audio_raw_view = safe_slice(audio, s_audio, e_audio)
+    s_audio, e_audio = clamp_range(int(t_start * fs_audio), int(t_end * fs_audio), len(audio))
+    
+    # Kênh rỗng -> mảng 0 để các đồ thị vẫn vẽ được (kiểm tra một lần cho mọi view)
+    (ecg_view, ecg_raw_view,
+     ppg_red_view, ppg_ir_view, ppg_red_raw_view, ppg_ir_raw_view,
+     audio_view, audio_raw_view) = (v if len(v) > 0 else np.zeros(100) for v in (
+        ecg_clean[s_ecg:e_ecg], ecg[s_ecg_raw:int(t_end * fs_ecg)],
+        ppg_red_clean[s_red:e_red], ppg_ir_clean[s_ir:e_ir],
+        ppg_red[s_red:e_red], ppg_ir[s_ir:e_ir],
+        audio_clean[s_audio:e_audio], audio[s_audio:e_audio]))
     
     # Tính HR
-    ecg_peaks, ecg_hr = detect_r_peaks(ecg_view, fs_ecg)
+    ecg_peaks, ecg_hr = detect_r_peaks(ecg_view, fs_ecg_clean)
     ppg_peaks, ppg_hr = detect_ppg_peaks(ppg_red_view, fs_ppg)
     
     # Tính SpO2 (Sử dụng đoạn tín hiệu hiển thị)
     spo2_val = calculate_spo2(ppg_red_raw_view, ppg_red_view, ppg_ir_raw_view, ppg_ir_view)
     
-    # Tạo trục thời gian
-    t_ecg = np.linspace(t_start, t_end, len(ecg_view))
-    t_ppg = np.linspace(t_start, t_end, len(ppg_red_view))
-    t_audio = np.linspace(t_start, t_end, len(audio_view))
-    
-    # === PLOT 1: FILTERED ===
-    fig_filt, ax_filt = plt.subplots(4, 1, figsize=(14, 12))
-    
-    # ECG Filtered
-    ax_filt[0].plot(t_ecg, ecg_view, 'orange', linewidth=1, label='ECG Filtered')
-    if len(ecg_peaks) > 0:
-        ax_filt[0].plot(t_ecg[ecg_peaks], ecg_view[ecg_peaks], 'r+', markersize=10, label='R-peaks')
-    ax_filt[0].set_title(f"ECG Filtered | Heart Rate: {ecg_hr:.0f} BPM", fontweight='bold')
-    ax_filt[0].set_ylabel("Amplitude")
-    ax_filt[0].legend(loc='upper right')
-    ax_filt[0].grid(True, alpha=0.4)
-    
-    # PPG Red Filtered
-    ax_filt[1].plot(t_ppg, ppg_red_view, 'red', linewidth=1)
-    if len(ppg_peaks) > 0:
-        ax_filt[1].plot(t_ppg[ppg_peaks], ppg_red_view[ppg_peaks], 'b*', markersize=8, label='Peaks')
-    ax_filt[1].set_title(f"PPG Red Filtered (660nm) | HR: {ppg_hr:.0f} BPM | SpO2: {spo2_val:.1f}%", fontweight='bold')
-    ax_filt[1].set_ylabel("Amplitude")
-    ax_filt[1].grid(True, alpha=0.4)
-    # ax_filt[1].invert_xaxis() # Removed inversion in plot display to match detect_r_peaks logic
-    
-    # PPG IR Filtered
-    ax_filt[2].plot(t_ppg, ppg_ir_view, 'green', linewidth=1)
-    ax_filt[2].set_title(f"PPG IR Filtered (880nm) | SpO2 Estimate: {spo2_val:.1f}%", fontweight='bold')
-    ax_filt[2].set_ylabel("Amplitude")
-    ax_filt[2].grid(True, alpha=0.4)
-    # ax_filt[2].invert_xaxis()
-    
-    # Audio 
-    ax_filt[3].plot(t_audio, audio_view, 'blue', linewidth=0.5)
-    ax_filt[3].set_title(f"Audio (INMP441) | Samples: {len(audio)}", fontweight='bold')
-    ax_filt[3].set_xlabel("Time (seconds)")
-    ax_filt[3].set_ylabel("Amplitude")
-    ax_filt[3].grid(True, alpha=0.4)
-
-    plt.tight_layout()
-    file_filt = output_file.replace(".png", "_filtered.png")
-    fig_filt.savefig(file_filt, dpi=150)
-    print(f"\n[OK] Saved Filtered Plot: {file_filt}")
-    plt.close(fig_filt)
-
-    # === PLOT 2: RAW ===
-    fig_raw, ax_raw = plt.subplots(4, 1, figsize=(14, 12))
-    
-    # ECG Raw
-    ax_raw[0].plot(t_ecg, ecg_raw_view, 'gray', linewidth=1)
-    ax_raw[0].set_title(f"ECG Raw (ADC Value)", fontweight='bold')
-    ax_raw[0].set_ylabel("ADC Value")
-    ax_raw[0].grid(True, alpha=0.4)
-    
-    # PPG Red Raw (Inverted)
-    ax_raw[1].plot(t_ppg, -ppg_red_raw_view, 'gray', linewidth=1)
-    ax_raw[1].set_title(f"PPG Red Raw (Inverted ADC)", fontweight='bold')
-    ax_raw[1].set_ylabel("Inverted ADC")
-    ax_raw[1].grid(True, alpha=0.4)
-    ax_raw[1].invert_xaxis()
-    
-    # PPG IR Raw (Inverted)
-    ax_raw[2].plot(t_ppg, -ppg_ir_raw_view, 'gray', linewidth=1)
-    ax_raw[2].set_title(f"PPG IR Raw (Inverted ADC)", fontweight='bold')
-    ax_raw[2].set_ylabel("Inverted ADC")
-    ax_raw[2].grid(True, alpha=0.4)
-    ax_raw[2].invert_xaxis()
-    
-    # Audio Raw
-    ax_raw[3].plot(t_audio, audio_raw_view, 'gray', linewidth=0.5)
-    ax_raw[3].set_title(f"Audio Raw (INMP441)", fontweight='bold')
-    ax_raw[3].set_xlabel("Time (seconds)")
-    ax_raw[3].set_ylabel("Raw Value")
-    ax_raw[3].grid(True, alpha=0.4)
-    
-    plt.tight_layout()
-    file_raw = output_file.replace(".png", "_raw.png")
-    fig_raw.savefig(file_raw, dpi=150)
-    print(f"[OK] Saved Raw Plot:      {file_raw}")
-    plt.close(fig_raw)
+    # Tạo trục thời gian (clean/raw cùng kênh PPG dùng chung một khoảng -> chung trục)
+    t_ecg = _time_axis(s_ecg, len(ecg_view), fs_ecg_clean)
+    t_ecg_raw = _time_axis(s_ecg_raw, len(ecg_raw_view), fs_ecg)
+    t_red = _time_axis(s_red, len(ppg_red_view), fs_ppg)
+    t_ir = _time_axis(s_ir, len(ppg_ir_view), fs_ppg)
+    t_audio = _time_axis(s_audio, len(audio_view), fs_audio)
+    
+    # Import matplotlib khi thật sự vẽ (tốn ~0.5s lúc khởi động).
+    # Figure + FigureCanvasAgg thay vì pyplot: chỉ lưu PNG, không đổi backend của bên gọi
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    
+    # rcParams chỉ áp dụng trong lúc vẽ -> không rò sang các figure khác của bên gọi
+    with matplotlib.rc_context({'path.simplify_threshold': 1.0, 'agg.path.chunksize': 10000}):
+        # Số điểm mỗi đường vẽ tỉ lệ theo độ phân giải ảnh (PLOT_MAX_POINTS ứng với 150 dpi)
+        decimate_trace = functools.partial(minmax_decimate,
+                                           max_points=max(4, int(PLOT_MAX_POINTS * dpi / 150)))
+        
+        # Dùng chung một Figure cho cả 2 ảnh (filtered, raw)
+        fig = Figure(figsize=(14, 12))
+        FigureCanvasAgg(fig)
+        
+        # === PLOT 1: FILTERED ===
+        ax_filt = fig.subplots(4, 1)
+        
+        # ECG Filtered
+        ax_filt[0].plot(*decimate_trace(t_ecg, ecg_view), 'orange', linewidth=1, label='ECG Filtered', rasterized=True)
+        if len(ecg_peaks) > 0:
+            ax_filt[0].plot(t_ecg[ecg_peaks], ecg_view[ecg_peaks], 'r+', markersize=10, label='R-peaks')
+        ax_filt[0].set_title(f"ECG Filtered | Heart Rate: {ecg_hr:.0f} BPM", fontweight='bold')
+        ax_filt[0].set_ylabel("Amplitude")
+        ax_filt[0].legend(loc='upper right')
+        ax_filt[0].grid(True, alpha=0.4)
+        
+        # PPG Red Filtered
+        ax_filt[1].plot(*decimate_trace(t_red, ppg_red_view), 'red', linewidth=1, rasterized=True)
+        if len(ppg_peaks) > 0:
+            ax_filt[1].plot(t_red[ppg_peaks], ppg_red_view[ppg_peaks], 'b*', markersize=8, label='Peaks')
+        ax_filt[1].set_title(f"PPG Red Filtered (660nm) | HR: {ppg_hr:.0f} BPM | SpO2: {spo2_val:.1f}%", fontweight='bold')
+        ax_filt[1].set_ylabel("Amplitude")
+        ax_filt[1].grid(True, alpha=0.4)
+        # ax_filt[1].invert_xaxis() # Removed inversion in plot display to match detect_r_peaks logic
+        
+        # PPG IR Filtered
+        ax_filt[2].plot(*decimate_trace(t_ir, ppg_ir_view), 'green', linewidth=1, rasterized=True)
+        ax_filt[2].set_title(f"PPG IR Filtered (880nm) | SpO2 Estimate: {spo2_val:.1f}%", fontweight='bold')
+        ax_filt[2].set_ylabel("Amplitude")
+        ax_filt[2].grid(True, alpha=0.4)
+        # ax_filt[2].invert_xaxis()
+        
+        # Audio 
+        ax_filt[3].plot(*decimate_trace(t_audio, audio_view), 'blue', linewidth=0.5, rasterized=True)
+        ax_filt[3].set_title(f"Audio (INMP441) | Samples: {len(audio)}", fontweight='bold')
+        ax_filt[3].set_xlabel("Time (seconds)")
+        ax_filt[3].set_ylabel("Amplitude")
+        ax_filt[3].grid(True, alpha=0.4)
+
+        fig.tight_layout()
+        file_filt = output_file.replace(".png", "_filtered.png")
+        fig.savefig(file_filt, dpi=dpi)
+        print(f"\n[OK] Saved Filtered Plot: {file_filt}")
+        fig.clf()
+
+        # === PLOT 2: RAW ===
+        ax_raw = fig.subplots(4, 1)
+        
+        # ECG Raw
+        ax_raw[0].plot(*decimate_trace(t_ecg_raw, ecg_raw_view), 'gray', linewidth=1, rasterized=True)
+        ax_raw[0].set_title(f"ECG Raw (ADC Value)", fontweight='bold')
+        ax_raw[0].set_ylabel("ADC Value")
+        ax_raw[0].grid(True, alpha=0.4)
+        
+        # PPG Red Raw (Inverted)
+        t_red_raw, red_raw_trace = decimate_trace(t_red, ppg_red_raw_view)
+        ax_raw[1].plot(t_red_raw, -red_raw_trace, 'gray', linewidth=1, rasterized=True)
+        ax_raw[1].set_title(f"PPG Red Raw (Inverted ADC)", fontweight='bold')
+        ax_raw[1].set_ylabel("Inverted ADC")
+        ax_raw[1].grid(True, alpha=0.4)
+        ax_raw[1].invert_xaxis()
+        
+        # PPG IR Raw (Inverted)
+        t_ir_raw, ir_raw_trace = decimate_trace(t_ir, ppg_ir_raw_view)
+        ax_raw[2].plot(t_ir_raw, -ir_raw_trace, 'gray', linewidth=1, rasterized=True)
+        ax_raw[2].set_title(f"PPG IR Raw (Inverted ADC)", fontweight='bold')
+        ax_raw[2].set_ylabel("Inverted ADC")
+        ax_raw[2].grid(True, alpha=0.4)
+        ax_raw[2].invert_xaxis()
+        
+        # Audio Raw
+        ax_raw[3].plot(*decimate_trace(t_audio, audio_raw_view), 'gray', linewidth=0.5, rasterized=True)
+        ax_raw[3].set_title(f"Audio Raw (INMP441)", fontweight='bold')
+        ax_raw[3].set_xlabel("Time (seconds)")
+        ax_raw[3].set_ylabel("Raw Value")
+        ax_raw[3].grid(True, alpha=0.4)
+        
+        fig.tight_layout()
+        file_raw = output_file.replace(".png", "_raw.png")
+        fig.savefig(file_raw, dpi=dpi)
+        print(f"[OK] Saved Raw Plot:      {file_raw}")
 
 def find_latest_log(data_dir):
     """Tìm file log mới nhất"""
-    files = glob.glob(os.path.join(data_dir, "serial_log_*.txt"))
-    return max(files, key=os.path.getmtime) if files else None
+    # scandir: tên file và stat đi kèm DirEntry, mỗi file chỉ stat một lần
+    latest, latest_mtime = None, -1
+    try:
+        with os.scandir(data_dir) as it:
+            for e in it:
+                if e.name.startswith("serial_log_") and e.name.endswith(".txt") and e.is_file():
+                    mtime = e.stat().st_mtime
+                    if mtime > latest_mtime:
+                        latest, latest_mtime = e.path, mtime
+    except FileNotFoundError:
+        return None
+    return latest
 
 def main():
     parser = argparse.ArgumentParser(description="ECG/PPG Signal Processor")
@@ -600,6 +916,9 @@ def main():
     parser.add_argument("--fs-ecg", type=int, default=DEFAULT_FS_ECG)
     parser.add_argument("--fs-ppg", type=int, default=DEFAULT_FS_PPG)
     parser.add_argument("--window", type=float, default=WINDOW_SEC, help="Display window (seconds)")
+    parser.add_argument("--wavelet", action='store_true', help="Enable wavelet denoising for PPG")
+    parser.add_argument("--dpi", type=int, default=150, help="Output image resolution")
+    parser.add_argument("--fast-plot", action='store_true', help="Quick preview (same as --dpi 100)")
     args = parser.parse_args()
     
     window_sec = args.window
@@ -629,7 +948,9 @@ def main():
     output_file = os.path.join(OUTPUT_DIR, f"result_{timestamp}.png")
     
     # Process and plot
-    create_plot(data, fs_config, output_file, window_sec)
+    create_plot(data, fs_config, output_file, window_sec,
+                cache_file=processed_cache_path(log_file, fs_config, args.wavelet),
+                use_wavelet=args.wavelet, dpi=100 if args.fast_plot else args.dpi)
     print("[DONE]")
 
 if __name__ == "__main__":
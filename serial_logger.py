@@ -7,6 +7,9 @@ import serial
 import serial.tools.list_ports
 import time
 import threading
+import argparse
+import selectors
+import queue
 import sys
 import os
 from datetime import datetime
@@ -16,10 +19,24 @@ BAUD_RATE = 460800
 OUTPUT_DIR = "data_logs"
 FLUSH_INTERVAL = 1.0  # Flush mỗi 1 giây thay vì mỗi dòng
 PRINT_EVERY_N = 100   # Chỉ in 1/100 dòng ra console (giảm overhead)
-running = True
+SELECT_TIMEOUT = 0.5  # Chờ dữ liệu tối đa 0.5s rồi kiểm tra lại cờ STOP (dự phòng, stop_reader đánh thức ngay)
+READ_SIZE = 65536     # Số byte tối đa mỗi lần os.read trên fd serial
+FILE_BUFFER_SIZE = 1 << 17  # Buffer ghi file 128 KiB (~2.5s dữ liệu ở 460800 baud)
+READER_CPU = -1       # Linux: ghim luồng đọc vào core này (-1 = core cuối, None = không ghim)
+READER_NICE = -5      # Tăng ưu tiên luồng đọc (cần quyền root/CAP_SYS_NICE, không có thì bỏ qua)
+RESET_PULSE_MS = int(os.environ.get("RESET_PULSE_MS", "20"))  # Chờ sau khi nhả DTR lúc mở cổng
+NO_RESET = os.environ.get("NO_RESET") == "1"  # Không đụng tới DTR khi mở cổng
+READ_TIMEOUT = 0.05   # Timeout của read(1) khi chờ byte đầu (Windows không có select)
+RX_BUFFER_SIZE = 1 << 16  # Windows: buffer nhận của driver COM (mặc định 4 KiB ~0.1s dữ liệu)
+STOP = threading.Event()  # Cờ dừng dùng chung giữa luồng chính và luồng đọc
 ser = None
+wake_fd = None  # Đầu ghi của self-pipe đánh thức selector khi dừng (POSIX)
+wake_lock = threading.Lock()  # Giữ wake_fd không bị đóng giữa lúc stop_reader() đọc và ghi
+write_error = None  # Lỗi ghi file log (đầy đĩa...) -> luồng đọc dừng và báo lại
 line_count = 0
 data_count = {"ecg": 0, "ppg": 0, "audio": 0}
+# Tiền tố đầu dòng -> loại dữ liệu (dòng bị lỗi truyền như ">eaw:..." không được đếm)
+COUNTER_KEY = {b">ecg": "ecg", b">ppg": "ppg", b">aud": "audio"}
 
 def list_ports():
     """Liệt kê tất cả các cổng serial"""
@@ -57,78 +74,230 @@ def find_esp32_port():
     
     return None
 
-def reader_thread_fast(filename):
+def stop_reader():
+    """Báo luồng đọc dừng, đánh thức nó nếu đang chờ trong selector"""
+    STOP.set()
+    with wake_lock:
+        fd = wake_fd
+        if fd is not None:
+            try:
+                os.write(fd, b"x")
+            except OSError:
+                pass  # Pipe đầy (đã có tín hiệu đánh thức đang chờ)
+
+def tune_reader_thread():
+    """Linux: ghim luồng đọc vào một core riêng và tăng ưu tiên để không bị lỡ dữ liệu UART"""
+    if READER_CPU is not None and hasattr(os, 'sched_setaffinity'):
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+            if len(cpus) > 1:
+                os.sched_setaffinity(0, {cpus[READER_CPU]})  # pid 0 = luồng hiện tại
+        except (OSError, IndexError) as e:
+            print(f"[INFO] Không ghim được CPU: {e}")
+    if READER_NICE and sys.platform.startswith('linux'):
+        try:
+            os.nice(READER_NICE)  # Linux: nice theo từng luồng
+        except OSError:
+            pass  # Không có quyền -> giữ ưu tiên mặc định
+
+def drop_page_cache(f):
+    """Log chỉ ghi, không đọc lại -> báo kernel bỏ các trang đã ghi khỏi page cache"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+def writer_failed(e):
+    """Ghi file lỗi: lưu lại lỗi và dừng luồng đọc thay vì tiếp tục dồn dữ liệu vào queue"""
+    global write_error
+    write_error = e
+    stop_reader()
+
+def writer_thread(f, q, echo=True):
+    """Luồng ghi file: nhận từng batch dòng từ queue, ghi và flush định kỳ"""
+    global line_count
+    # Console không có .buffer (IDLE, một số IDE) -> in bằng print; --quiet thì không đụng tới stdout
+    out = getattr(sys.stdout, 'buffer', None) if echo else None
+    # Đồng hồ monotonic: không nhảy khi đổi giờ hệ thống, rẻ hơn time.time()
+    next_flush = time.monotonic() + FLUSH_INTERVAL
+    queued = 0  # Số dòng đã đưa vào buffer file; line_count chỉ tính dòng đã flush xuống file
+    
+    stopped = False
+    try:
+        while not stopped:
+            # Chờ batch đầu tiên rồi gom luôn các batch đang đợi -> một lần ghi cho tất cả
+            batch = q.get()
+            try:
+                while True:
+                    batch += q.get_nowait()
+            except queue.Empty:
+                pass
+            if batch[-1] is None:  # Luồng đọc đã dừng (None luôn là phần tử cuối cùng)
+                batch.pop()
+                stopped = True
+            
+            # Ghi cả batch [dòng, b"\n", dòng, b"\n", ...] trong một lần gọi (không flush ngay)
+            f.writelines(batch)
+            prev_count = queued
+            queued += len(batch) // 2
+            
+            # In mẫu mỗi PRINT_EVERY_N dòng (giảm overhead console; tắt hẳn với --quiet).
+            # Ghi bytes thẳng vào sys.stdout.buffer (không decode/encode, không khóa print từng dòng),
+            # gom cả batch rồi flush một lần
+            if echo:
+                echo_batch = [b"[%d] %s...\n" % (n, batch[2 * (n - prev_count - 1)][:60])
+                              for n in range((prev_count // PRINT_EVERY_N + 1) * PRINT_EVERY_N,
+                                             queued + 1, PRINT_EVERY_N)]
+                if echo_batch:
+                    try:
+                        if out is not None:
+                            out.write(b"".join(echo_batch))
+                            out.flush()
+                        else:
+                            print(b"".join(echo_batch).decode(errors='replace'), end='', flush=True)
+                    except Exception:
+                        echo = False  # stdout hỏng (pipe bị đóng...) -> tắt echo, vẫn ghi file
+            
+            # Flush định kỳ (và lần cuối khi luồng đọc dừng)
+            now = time.monotonic()
+            if stopped or now >= next_flush:
+                f.flush()
+                line_count = queued
+                drop_page_cache(f)
+                next_flush = now + FLUSH_INTERVAL
+    except Exception as e:
+        writer_failed(e)
+
+def reader_thread_fast(filename, echo=True):
     """Luồng đọc dữ liệu tối ưu - High Throughput"""
-    global running, ser, line_count, data_count
+    global ser, data_count, wake_fd, write_error
     print(f"\n[Đang ghi vào {filename}]")
     print("[Nhấn Ctrl+C để thoát]\n")
     
-    buffer = ""
-    last_flush = time.time()
-    last_stats = time.time()
+    buffer = b""
+    last_stats = time.monotonic()
     
-    with open(filename, 'w', encoding='utf-8', buffering=8192) as f:
-        f.write(f"# Log Start: {datetime.now()}\n")
-        
-        while running:
-            try:
-                # Đọc tất cả bytes có sẵn (không blocking)
-                if ser and ser.in_waiting > 0:
-                    chunk = ser.read(ser.in_waiting).decode('utf-8', errors='ignore')
-                    buffer += chunk
-                    
-                    # Xử lý từng dòng hoàn chỉnh
-                    while '\n' in buffer:
-                        line, buffer = buffer.split('\n', 1)
-                        line = line.strip()
-                        if line:
-                            # Ghi vào file (không flush ngay)
-                            f.write(line + "\n")
-                            line_count += 1
-                            
-                            # Đếm loại dữ liệu
-                            if line.startswith(">ecg"):
-                                data_count["ecg"] += 1
-                            elif line.startswith(">ppg"):
-                                data_count["ppg"] += 1
-                            elif line.startswith(">audio"):
-                                data_count["audio"] += 1
-                            
-                            # In mẫu (giảm overhead console)
-                            if line_count % PRINT_EVERY_N == 0:
-                                print(f"[{line_count}] {line[:60]}...")
-                            
-                            # Tự động thoát
-                            if "# DONE." in line:
-                                print(f"\n[INFO] Measurement Complete!")
-                                print(f"[STATS] ECG: {data_count['ecg']}, PPG: {data_count['ppg']//2} pairs")
-                                running = False
-                                break
-                    
-                    # Flush định kỳ
-                    now = time.time()
-                    if now - last_flush >= FLUSH_INTERVAL:
-                        f.flush()
-                        last_flush = now
-                    
-                    # In thống kê định kỳ
-                    if now - last_stats >= 5.0:
-                        elapsed = now - last_stats
-                        ecg_rate = data_count["ecg"] / elapsed if elapsed > 0 else 0
-                        ppg_rate = (data_count["ppg"] / 2) / elapsed if elapsed > 0 else 0
-                        print(f"[LIVE] ECG: ~{ecg_rate:.0f} Hz, PPG: ~{ppg_rate:.0f} Hz")
-                        data_count = {"ecg": 0, "ppg": 0, "audio": 0}
-                        last_stats = now
-                else:
-                    time.sleep(0.001)  # Giảm sleep time, tăng responsiveness
-                    
-            except Exception as e:
-                if running:
-                    print(f"Lỗi đọc: {e}")
-                break
-        
-        # Final flush
-        f.flush()
+    # POSIX: ngủ trên fd của cổng serial tới khi có dữ liệu (thay vì sleep 1ms rồi poll),
+    # kèm self-pipe để stop_reader() đánh thức ngay. macOS: kqueue/poll không hỗ trợ
+    # thiết bị tty -> dùng select(). Windows không select được trên handle COM
+    # -> read(1) chờ theo timeout của cổng.
+    sel = None
+    if sys.platform != 'win32':
+        sel = selectors.SelectSelector() if sys.platform == 'darwin' else selectors.DefaultSelector()
+        serial_fd = ser.fileno()
+        sel.register(serial_fd, selectors.EVENT_READ)
+        wake_r, wake_w = os.pipe()
+        os.set_blocking(wake_w, False)  # stop_reader() ghi khi giữ khóa -> không được chặn
+        with wake_lock:
+            wake_fd = wake_w
+        sel.register(wake_r, selectors.EVENT_READ)
+    
+    # Ghi file ở chế độ nhị phân: dữ liệu serial là ASCII, không cần decode/encode lại.
+    # O_APPEND: mọi lần ghi nối vào cuối file; O_CLOEXEC: không rò fd sang tiến trình con
+    flags = (os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+             | getattr(os, 'O_CLOEXEC', 0) | getattr(os, 'O_BINARY', 0))
+    try:
+        with open(os.open(filename, flags, 0o644), 'wb', buffering=FILE_BUFFER_SIZE) as f:
+            f.write(f"# Log Start: {datetime.now()}\n".encode())
+            
+            # Ghi đĩa ở luồng riêng: ổ đĩa chậm/khựng không làm luồng đọc bỏ lỡ dữ liệu serial.
+            # SimpleQueue không giới hạn: khi đĩa khựng dữ liệu dồn vào RAM thay vì chặn luồng đọc
+            q = queue.SimpleQueue()
+            writer = threading.Thread(target=writer_thread, args=(f, q, echo))
+            writer.daemon = True
+            writer.start()
+            
+            # Ghim CPU/nice sau khi tạo luồng ghi: luồng con trên Linux kế thừa affinity và nice
+            # của luồng tạo ra nó -> luồng ghi không tranh core riêng của luồng đọc
+            tune_reader_thread()
+            
+            while not STOP.is_set():
+                try:
+                    if sel is not None:
+                        events = sel.select(timeout=SELECT_TIMEOUT)
+                        if not any(key.fd == serial_fd for key, _ in events):
+                            continue  # Hết giờ chờ hoặc bị stop_reader() đánh thức
+                        # Đọc thẳng từ fd: một syscall lấy hết dữ liệu đang có
+                        try:
+                            raw = os.read(serial_fd, READ_SIZE)
+                        except BlockingIOError:
+                            continue
+                        if not raw:  # Báo sẵn sàng nhưng không có dữ liệu = thiết bị bị rút ra
+                            raise serial.SerialException("device disconnected")
+                    else:
+                        # Có sẵn dữ liệu -> đọc hết trong một lần; chưa có -> read(1) chờ byte đầu
+                        # rồi đọc nốt phần vừa tới
+                        n = ser.in_waiting
+                        raw = ser.read(n) if n else ser.read(1) + ser.read(ser.in_waiting)
+                    if raw:
+                        buffer += raw
+                        
+                        # Phần dữ liệu gồm các dòng hoàn chỉnh, phần dư (chưa có '\n') giữ lại chờ chunk sau
+                        end = buffer.rfind(b'\n') + 1
+                        # Tự động thoát: chỉ ghi tới hết dòng "# DONE."
+                        done = buffer.find(b"# DONE.", 0, end)
+                        if done >= 0:
+                            end = buffer.index(b'\n', done) + 1
+                        complete, buffer = buffer[:end], buffer[end:]
+                        
+                        # Đếm loại dữ liệu cho cả chunk bằng bytes.count (C-level), không tra từng dòng;
+                        # buffer luôn bắt đầu ở đầu một dòng
+                        for prefix, key in COUNTER_KEY.items():
+                            data_count[key] += complete.count(b"\n" + prefix) + complete.startswith(prefix)
+                        
+                        batch = []
+                        for line in complete.split(b'\n'):
+                            line = line.strip()
+                            if line:
+                                batch.append(line)
+                                batch.append(b"\n")
+                        if batch:
+                            q.put(batch)
+                        
+                        if done >= 0:
+                            print(f"\n[INFO] Measurement Complete!")
+                            print(f"[STATS] ECG: {data_count['ecg']}, PPG: {data_count['ppg']//2} pairs")
+                            STOP.set()
+                            break
+                        
+                        # In thống kê định kỳ
+                        now = time.monotonic()
+                        if now - last_stats >= 5.0:
+                            elapsed = now - last_stats
+                            ecg_rate = data_count["ecg"] / elapsed if elapsed > 0 else 0
+                            ppg_rate = (data_count["ppg"] / 2) / elapsed if elapsed > 0 else 0
+                            print(f"[LIVE] ECG: ~{ecg_rate:.0f} Hz, PPG: ~{ppg_rate:.0f} Hz")
+                            data_count = {"ecg": 0, "ppg": 0, "audio": 0}
+                            last_stats = now
+                        
+                except Exception as e:
+                    if not STOP.is_set():
+                        print(f"Lỗi đọc: {e}")
+                    break
+            
+            # Chờ luồng ghi xả hết queue rồi mới đóng file
+            q.put([None])
+            writer.join()
+            
+            # Final flush (và đẩy xuống đĩa: phiên đo đã kết thúc)
+            f.flush()
+            os.fsync(f.fileno())
+            drop_page_cache(f)
+    except OSError as e:
+        # Mở/ghi/đóng file lỗi (đầy đĩa, mất quyền...) -> ghi nhận thay vì để luồng đọc chết
+        write_error = write_error or e
+    
+    if write_error is not None:
+        print(f"\n[LỖI GHI] {write_error}")
+        print(f"[STATS] Chỉ ghi được {line_count} dòng vào {filename}, dữ liệu sau đó bị bỏ")
+    
+    if sel is not None:
+        sel.close()
+        with wake_lock:
+            wake_fd = None
+            os.close(wake_w)
+        os.close(wake_r)
 
 def open_serial_macos(port_name):
     """Mở serial port trên macOS"""
@@ -137,7 +306,7 @@ def open_serial_macos(port_name):
     ser = serial.Serial()
     ser.port = port_name
     ser.baudrate = BAUD_RATE
-    ser.timeout = 0.01  # Giảm timeout
+    ser.timeout = READ_TIMEOUT
     ser.dtr = False
     ser.rts = False
     
@@ -154,7 +323,16 @@ def open_serial_macos(port_name):
         return False
 
 def main():
-    global running, ser
+    global ser
+    parser = argparse.ArgumentParser(description="ESP32 Serial Logger")
+    parser.add_argument("--quiet", action='store_true',
+                        help="Không in mẫu dữ liệu ra console khi ghi")
+    parser.add_argument("--echo", action='store_true',
+                        help="In mẫu dữ liệu cả khi stdout không phải terminal (pipe/file)")
+    args = parser.parse_args()
+    # Mặc định chỉ in mẫu khi stdout là terminal, chuyển hướng ra pipe/file thì bỏ qua
+    echo = not args.quiet and (args.echo or sys.stdout.isatty())
+    
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     
     print("=" * 50)
@@ -194,24 +372,31 @@ def main():
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = os.path.join(OUTPUT_DIR, f"serial_log_{timestamp}.txt")
     
+    reader = None
     try:
         # Mở serial port
         if sys.platform == 'darwin':
             if not open_serial_macos(port_name):
                 return
         else:
-            ser = serial.Serial(port_name, BAUD_RATE, timeout=0.01)
-            ser.setDTR(False)
-            time.sleep(0.1)
+            ser = serial.Serial(port_name, BAUD_RATE, timeout=READ_TIMEOUT)
+            if sys.platform == 'win32':
+                try:
+                    ser.set_buffer_size(rx_size=RX_BUFFER_SIZE)
+                except serial.SerialException:
+                    pass  # Driver không cho đổi -> giữ buffer mặc định
+            if not NO_RESET:
+                ser.dtr = False
+                time.sleep(RESET_PULSE_MS / 1000)
         
         # Bắt đầu luồng đọc
-        t = threading.Thread(target=reader_thread_fast, args=(filename,))
-        t.daemon = True
-        t.start()
+        reader = threading.Thread(target=reader_thread_fast, args=(filename, echo))
+        reader.daemon = True
+        reader.start()
         
         # Vòng lặp chính
         print("\n[READY] Nhấn ENTER để bắt đầu đo (gửi lệnh đến ESP32)")
-        while running:
+        while not STOP.is_set():
             try:
                 cmd = input()
                 if ser and ser.is_open:
@@ -222,7 +407,7 @@ def main():
                 
     except KeyboardInterrupt:
         print("\n\nĐang dừng...")
-        running = False
+        stop_reader()
     except serial.SerialException as e:
         print(f"\n[LỖI SERIAL] {e}")
         print("\nGợi ý:")
@@ -232,8 +417,10 @@ def main():
     except Exception as e:
         print(f"\n[LỖI] {e}")
     finally:
-        running = False
-        time.sleep(0.2)
+        stop_reader()
+        # Chờ luồng đọc ghi nốt và fsync file log trước khi đóng cổng/thoát
+        if reader is not None:
+            reader.join(timeout=5.0)
         if ser and ser.is_open:
             ser.close()
             print("[OK] Đã đóng cổng serial")